@@ -1,15 +1,21 @@
 from .externalconfig import (
     add_from_dict,
+    batch,
+    clear_cache,
     reset_configuration,
     update_from_environment,
     update_from_dict,
     update_from_multilevel_dictfile,
+    update_from_multilevel_dictfiles,
 )
 
 __all__ = (
     "add_from_dict",
+    "batch",
+    "clear_cache",
     "reset_configuration",
     "update_from_environment",
     "update_from_dict",
     "update_from_multilevel_dictfile",
+    "update_from_multilevel_dictfiles",
 )
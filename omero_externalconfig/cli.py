@@ -3,24 +3,64 @@
 # Strict type annotations without annotations on omero.* is difficult
 # type: ignore
 
+import fnmatch
 from glob import glob
 import logging
 import os
+import re
+import stat
 from omero.cli import BaseControl
-from . import (
-    reset_configuration,
-    update_from_environment,
-    update_from_multilevel_dictfile,
-)
+from . import batch
+from .externalconfig import _load_multilevel_dictfiles
 
 
 DEFAULT_LOGLEVEL = logging.WARNING
 
+# Characters that make a path component a glob pattern
+_GLOB_MAGIC = re.compile("[*?[]")
+
+# OMERODIR values that have already been checked to be directories
+_OMERODIR_CACHE = set()
+
+
+def _isdir(path):
+    try:
+        return stat.S_ISDIR(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def _expand_glob(pattern):
+    """
+    Expand a shell glob pattern, returning sorted matches.
+    If only the final path component contains wildcards the directory is
+    scanned once with os.scandir instead of using glob.
+    """
+    d, pat = os.path.split(pattern)
+    if not pat or "**" in pattern or _GLOB_MAGIC.search(d):
+        return sorted(glob(pattern))
+    if not _GLOB_MAGIC.search(pat):
+        # No wildcards, like glob only check the path exists
+        return [pattern] if os.path.lexists(pattern) else []
+    try:
+        with os.scandir(d or os.curdir) as it:
+            names = [e.name for e in it]
+    except OSError:
+        return []
+    if not pat.startswith("."):
+        # Like glob, wildcards don't match hidden files
+        names = [n for n in names if not n.startswith(".")]
+    return sorted(os.path.join(d, n) for n in fnmatch.filter(names, pat))
+
 
 def _omerodir(ctx):
     omerodir = os.getenv("OMERODIR")
-    if not omerodir or not os.path.isdir(omerodir):
+    if omerodir in _OMERODIR_CACHE:
+        return omerodir
+    if not omerodir or not _isdir(omerodir):
         ctx.die(100, "OMERODIR not set")
+    else:
+        _OMERODIR_CACHE.add(omerodir)
     return omerodir
 
 
@@ -64,16 +104,21 @@ class ExternalConfigControl(BaseControl):
         logging.getLogger("omero_externalconfig").setLevel(level=loglevel)
         omerodir = _omerodir(self.ctx)
 
-        if args.reset:
-            reset_configuration(omerodir)
-
+        files = []
         for inputf in args.file:
             if args.glob:
-                files = sorted(glob(inputf))
+                files.extend(_expand_glob(inputf))
             else:
-                files = [inputf]
-            for f in files:
-                update_from_multilevel_dictfile(omerodir, f)
-
-        if args.fromenv:
-            update_from_environment(omerodir)
+                files.append(inputf)
+
+        # Parse all files before config.xml is opened so nothing is changed,
+        # including the reset, if any file is invalid
+        ds = _load_multilevel_dictfiles(files)
+
+        # Write config.xml once after all changes
+        with batch(omerodir) as b:
+            if args.reset:
+                b.reset_configuration()
+            b._update_from_multilevel_dicts(ds)
+            if args.fromenv:
+                b.update_from_environment()
@@ -4,20 +4,70 @@
 Configure OMERO from external data-sources
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+import hashlib
 import json
 import logging
 import os
-from re import sub
-from tempfile import TemporaryDirectory
-from typing import Any, Dict, List, Optional, Union
-from omero.config import ConfigXml  # type: ignore
-from omero.util import pydict_text_io  # type: ignore
+import stat
+from tempfile import NamedTemporaryFile
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+import yaml
+
+# omero.* imports are slow so they're deferred until they're needed
+if TYPE_CHECKING:
+    from omero.config import ConfigXml  # type: ignore
+
+# Use LibYAML if PyYAML was built with it
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# orjson is only used to parse dictfiles. Property values and the JSON cache
+# are written by json.dumps so they're read with json.loads, orjson can't read
+# NaN or Infinity and converts integers larger than 64 bits to floats
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
 
 log = logging.getLogger("omero_externalconfig")
 
 JSONDict = Dict[str, Any]
 DictOrList = Union[Dict[Any, Any], List[Any]]
 
+# Prefix of environment variables used by update_from_environment
+_ENV_PREFIX = "CONFIG_"
+_ENV_PREFIX_LEN = len(_ENV_PREFIX)
+_ENV_KEY_TRANS = str.maketrans({"_": "."})
+
+# Serialise property values to JSON with a stable key order.
+# orjson isn't used for this since it doesn't support the separators used by
+# json.dumps, which would change the format of properties in config.xml
+_dumps = partial(json.dumps, sort_keys=True, ensure_ascii=False)
+
+# Parsed dictfiles keyed by absolute path: (st_mtime_ns, st_size, content)
+_DICTFILE_CACHE = {}  # type: Dict[str, Tuple[int, int, Any]]
+
+# Shared jinja2.Environment
+_J2_ENV = None  # type: Any
+# The template each thread is loading, the only one _read_jinja2_source returns
+_J2_LOADING = threading.local()
+
 
 class ExternalConfigException(Exception):
     """
@@ -27,11 +77,26 @@ class ExternalConfigException(Exception):
     pass
 
 
-def _get_config_xml(omerodir: str) -> ConfigXml:
+def _decode_env_key(name: str) -> str:
+    """
+    Convert an environment variable name (without the CONFIG_ prefix) to a
+    property name.
+    Each run of n underscores becomes n // 2 underscores, followed by a "."
+    if n is odd.
+    """
+    # Environment variable names can't contain NUL so it's a safe placeholder
+    # for an escaped underscore
+    return name.replace("__", "\0").translate(_ENV_KEY_TRANS).replace("\0", "_")
+
+
+def _get_config_xml(omerodir: str) -> "ConfigXml":
+    from omero.config import ConfigXml
+
     return ConfigXml(os.path.join(omerodir, "etc", "grid", "config.xml"))
 
 
-def _get_omeroweb_default(key: str) -> Optional[DictOrList]:
+@lru_cache(maxsize=1024)
+def _load_omeroweb_default(key: str) -> Optional[DictOrList]:
     """
     Based on
     https://github.com/ome/omero-py/blob/v5.8.0/src/omero/plugins/prefs.py#L368
@@ -54,88 +119,476 @@ def _get_omeroweb_default(key: str) -> Optional[DictOrList]:
     return default
 
 
-def _get_current_as_json(config: ConfigXml, key: str) -> Optional[DictOrList]:
+def _get_current_as_json(props: Mapping[str, str], key: str) -> Optional[DictOrList]:
     """
     Get current key value converted from JSON to a list or dict,
     taking into account OMERO.web's defaults
+
+    :param props: The current properties, from ConfigXml.as_map()
+    :return: The current value, this may be shared so must not be modified
     """
-    if key in config.keys():
-        current = json.loads(config[key])
+    if key in props:
+        current = json.loads(props[key])
         if not isinstance(current, (dict, list)):
             raise ExternalConfigException(
                 "Property {} is not a dict or list: {}".format(key, current)
             )
         return current
     if key.startswith("omero.web."):
-        return _get_omeroweb_default(key)
+        return _load_omeroweb_default(key)
     return None
 
 
-def _add_to_dict(config: ConfigXml, key: str, values: JSONDict) -> JSONDict:
+def _add_to_dict(props: Mapping[str, str], key: str, values: JSONDict) -> JSONDict:
     """
-    Add values to a dict
+    Add values to a new dict, without modifying the current value
     """
-    current = _get_current_as_json(config, key)
+    current = _get_current_as_json(props, key)
     if current is None:
         # Key doesn't have a value so just return input instead of trying to
         # figure out the type
         return values
     if isinstance(current, dict):
-        current.update(values)
-        return current
+        return {**current, **values}
     raise ExternalConfigException(
         "Expected dict for key:{} current:{}".format(key, current)
     )
 
 
-def _append_to_list(config: ConfigXml, key: str, values: List[Any]) -> List[Any]:
+def _append_to_list(props: Mapping[str, str], key: str, values: List[Any]) -> List[Any]:
     """
-    Append values to a list.
+    Append values to a new list, without modifying the current value.
     Based on
     https://github.com/ome/omero-py/blob/v5.8.0/src/omero/plugins/prefs.py#L383
     """
-    current = _get_current_as_json(config, key)
+    current = _get_current_as_json(props, key)
     if current is None:
         # Key doesn't have a value so just return input instead of trying to
         # figure out the type
         return values
     if isinstance(current, list):
-        current.extend(values)
-        return current
+        return current + values
     raise ExternalConfigException(
         "Expected list for key:{} current:{}".format(key, current)
     )
 
 
-def _parse_jinja2(j2file: str, tmpdir: str) -> str:
+def _update_from_dict_with_cfg(cfg: "ConfigXml", dj: Dict[str, Any]) -> None:
+    """
+    Set properties on an already open ConfigXml, see update_from_dict
+    """
+    dumps = _dumps
+    info = log.info
+    info_enabled = log.isEnabledFor(logging.INFO)
+    is_instance = isinstance
+    for (k, v) in dj.items():
+        if not is_instance(v, str):
+            v = dumps(v)
+        if info_enabled:
+            info("Setting: %s=%s", k, v)
+        cfg[k] = v
+
+
+def _apply_merges(cfg: "ConfigXml", merges: Dict[str, DictOrList]) -> None:
+    """
+    Add to properties on an already open ConfigXml, see add_from_dict.
+    The current properties are read from cfg once, then each property is
+    parsed, merged and serialised once.
+    """
+    dumps = _dumps
+    info = log.info
+    info_enabled = log.isEnabledFor(logging.INFO)
+    append_to_list = _append_to_list
+    add_to_dict = _add_to_dict
+    # Adding keys from merges doesn't affect the lookup of other keys in merges
+    props = cfg.as_map()
+    jv = []  # type: DictOrList
+    for (k, vs) in merges.items():
+        # isinstance is not aliased since mypy needs it to narrow the type
+        if isinstance(vs, list):
+            jv = append_to_list(props, k, vs)
+            if info_enabled:
+                info("Appending: %s=%s", k, jv)
+        elif isinstance(vs, dict):
+            jv = add_to_dict(props, k, vs)
+            if info_enabled:
+                info("Adding: %s=%s", k, jv)
+        cfg[k] = dumps(jv)
+
+
+def _read_jinja2_source(path: str) -> Optional[Tuple[str, str, None]]:
+    """
+    Jinja2 FunctionLoader that only loads the template _render_jinja2 is
+    loading, so like jinja2.Template other templates can't be included.
+    Otherwise the dictfile caches would have to track included files.
+    uptodate is always None since the environment doesn't cache templates
+    """
+    if path != getattr(_J2_LOADING, "path", None):
+        return None
+    with open(path) as f:
+        return f.read(), path, None
+
+
+def _get_jinja2_env() -> Any:
+    """
+    Get the shared Jinja2 environment, creating it on first use since jinja2
+    is an optional dependency.
+    If OMERO_EXTERNALCONFIG_J2_CACHE is set compiled templates will be cached
+    in that directory.
+    """
+    global _J2_ENV
+    if _J2_ENV is None:
+        try:
+            import jinja2
+        except ImportError as e:
+            raise ExternalConfigException(
+                "j2 file processing requires the jinja2 module"
+            ) from e
+        bytecode_cache = None
+        cachedir = os.getenv("OMERO_EXTERNALCONFIG_J2_CACHE")
+        if cachedir:
+            os.makedirs(cachedir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(directory=cachedir)
+        _J2_ENV = jinja2.Environment(
+            loader=jinja2.FunctionLoader(_read_jinja2_source),
+            autoescape=False,
+            bytecode_cache=bytecode_cache,
+            # The rendered output is cached with the parsed dictfile, a template
+            # is only loaded again if the file has changed
+            cache_size=0,
+        )
+    return _J2_ENV
+
+
+def _render_jinja2(j2file: str) -> str:
+    if not j2file.endswith(".j2") or len(j2file) < 4:
+        raise ExternalConfigException("Invalid j2 file name")
+    env = _get_jinja2_env()
+    path = os.path.abspath(j2file)
+    _J2_LOADING.path = path
+    try:
+        template = env.get_template(path)
+    finally:
+        _J2_LOADING.path = None
+    return str(template.render())
+
+
+def _load_text(text: Union[str, bytes], dictfile: str) -> Any:
+    """
+    Parse the content of a YAML or JSON file, the format is determined by the
+    file extension
+    """
+    ext = os.path.splitext(dictfile)[1].lower()
+    if ext in (".yml", ".yaml"):
+        docs = list(yaml.load_all(text, Loader=_YamlLoader))
+        if len(docs) != 1:
+            raise ExternalConfigException(
+                "Expected YAML file with one document, found {}".format(len(docs))
+            )
+        return docs[0]
+    if ext in (".js", ".json"):
+        return _loads(text)
+    raise ExternalConfigException("Unknown file format: {}".format(dictfile))
+
+
+def _fast_load(dictfile: str) -> Any:
+    """
+    Load a YAML file with PyYAML, using the LibYAML parser if it's
+    available, or a JSON file with orjson if it's installed.
+    Other files are loaded with pydict_text_io
+    """
+    if dictfile.lower().endswith((".yml", ".yaml", ".js", ".json")):
+        with open(dictfile, "rb") as f:
+            return _load_text(f.read(), dictfile)
+    from omero.util import pydict_text_io  # type: ignore
+
+    return pydict_text_io.load(dictfile)
+
+
+def _load_dictfile(dictfile: str) -> Any:
+    if dictfile.endswith(".j2"):
+        # Parse the rendered template in memory, the format is determined by
+        # the name without .j2
+        return _load_text(_render_jinja2(dictfile), dictfile[:-3])
+    return _fast_load(dictfile)
+
+
+def _get_sidecar_path(path: str) -> Optional[str]:
+    """
+    Get the path of the JSON cache for a dictfile, or None if
+    OMERO_EXTERNALCONFIG_CACHE is not set
+    """
+    cachedir = os.getenv("OMERO_EXTERNALCONFIG_CACHE")
+    if not cachedir:
+        return None
+    # fsencode since POSIX file names aren't necessarily valid UTF-8
+    name = hashlib.sha1(os.fsencode(path)).hexdigest() + ".json"
+    return os.path.join(cachedir, name)
+
+
+def _write_sidecar(sidecar: str, st: os.stat_result, d: Any) -> None:
+    """
+    Atomically write the JSON cache for a dictfile. Content that doesn't
+    survive a round-trip through JSON (e.g. non-string keys, dates) is not
+    cached.
+    """
+    cached = {"_src_mtime_ns": st.st_mtime_ns, "_src_size": st.st_size, "content": d}
+    try:
+        content = json.dumps(cached, ensure_ascii=False)
+        if json.loads(content)["content"] != d:
+            log.debug("Not caching %s: not representable as JSON", sidecar)
+            return
+    except (TypeError, ValueError) as e:
+        log.debug("Not caching %s: %s", sidecar, e)
+        return
+    f = NamedTemporaryFile(
+        "w", dir=os.path.dirname(sidecar), suffix=".tmp", delete=False, encoding="utf-8"
+    )
+    try:
+        with f:
+            f.write(content)
+        os.replace(f.name, sidecar)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
+
+def _is_trusted(st: os.stat_result) -> bool:
+    """
+    Check a JSON cache file or directory is owned by the current user and
+    isn't writeable by anyone else, since the cache content is applied to
+    config.xml
+    """
+    if not hasattr(os, "getuid"):
+        # Not POSIX
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _load_with_sidecar(dictfile: str, st: os.stat_result) -> Any:
+    """
+    Load a dictfile, using the JSON cache in OMERO_EXTERNALCONFIG_CACHE if
+    it's set and matches the dictfile's modification time and size
+    """
+    sidecar = _get_sidecar_path(os.path.abspath(dictfile))
+    if not sidecar:
+        return _load_dictfile(dictfile)
+    cachedir = os.path.dirname(sidecar)
+    try:
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        trusted = _is_trusted(os.stat(cachedir))
+    except OSError as e:
+        log.warning("Failed to create JSON cache directory %s: %s", cachedir, e)
+        return _load_dictfile(dictfile)
+    if not trusted:
+        log.warning(
+            "Not using JSON cache %s: it must be owned by the current user and "
+            "not writeable by others",
+            cachedir,
+        )
+        return _load_dictfile(dictfile)
+    try:
+        with open(sidecar, encoding="utf-8") as f:
+            if not _is_trusted(os.fstat(f.fileno())):
+                raise ValueError("owned by another user or writeable by others")
+            cached = json.load(f)
+        if (cached["_src_mtime_ns"], cached["_src_size"]) == (
+            st.st_mtime_ns,
+            st.st_size,
+        ):
+            log.debug("Using JSON cache %s for %s", sidecar, dictfile)
+            return cached["content"]
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.debug("Ignoring invalid JSON cache %s: %s", sidecar, e)
+    d = _load_dictfile(dictfile)
+    try:
+        _write_sidecar(sidecar, st, d)
+    except OSError as e:
+        log.warning("Failed to write JSON cache %s: %s", sidecar, e)
+    return d
+
+
+def _cached_load(dictfile: str) -> Any:
+    """
+    Load a dictfile, reusing the previously parsed content if the file's
+    modification time and size are unchanged.
+    The content is returned by reference so it must not be modified.
+    """
+    path = os.path.abspath(dictfile)
     try:
-        import jinja2
-    except ImportError as e:
+        st = os.stat(path)
+    except OSError:
+        # Not a file, pydict_text_io also accepts a JSON string
+        return _load_dictfile(dictfile)
+    cached = _DICTFILE_CACHE.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        log.debug("Using cached %s", dictfile)
+        return cached[2]
+    d = _load_with_sidecar(dictfile, st)
+    _DICTFILE_CACHE[path] = (st.st_mtime_ns, st.st_size, d)
+    return d
+
+
+def _load_multilevel_dictfile(dictfile: str) -> Any:
+    try:
+        return _cached_load(dictfile)
+    except Exception as e:
         raise ExternalConfigException(
-            "j2 file processing requires the jinja2 module"
+            "Failed to parse {}: {}".format(dictfile, e)
         ) from e
-    if not j2file.endswith(".j2") or len(j2file) < 4:
-        raise ExternalConfigException("Invalid j2 file name")
-    out = j2file[:-3]
-    outpath = os.path.join(tmpdir, out)
-    with open(j2file) as f:
-        template = jinja2.Template(f.read())
-        with open(outpath, "w") as o:
-            o.write(template.render())
-    return outpath
 
 
-def reset_configuration(omerodir: str) -> None:
+def _update_from_multilevel_dict_with_cfg(cfg: "ConfigXml", d: Any) -> None:
     """
-    Delete current OMERO config.xml properties.
+    Apply the _set and _append top-level keys of a multi-level dictionary to
+    an already open ConfigXml, see update_from_multilevel_dictfile
+    """
+    for topk in sorted(d):
+        topv = d[topk]
+        if topk.endswith("_append"):
+            _apply_merges(cfg, topv)
+        elif topk.endswith("_set"):
+            _update_from_dict_with_cfg(cfg, topv)
+        else:
+            log.warning("Ignoring top-level key {}".format(topk))
+
+
+def _load_multilevel_dictfiles(dictfiles: Sequence[str]) -> List[Any]:
+    """
+    Read and parse multiple multi-level dictfiles in parallel
+    """
+    if len(dictfiles) > 1:
+        with ThreadPoolExecutor(max_workers=min(8, len(dictfiles))) as executor:
+            return list(executor.map(_load_multilevel_dictfile, dictfiles))
+    return [_load_multilevel_dictfile(f) for f in dictfiles]
+
+
+class _Batch(object):
+    """
+    Apply multiple updates to config.xml, which is only opened when the first
+    change is made and saved once when the batch is closed.
+    Each method is equivalent to the module level function of the same name.
+    """
+
+    def __init__(self, omerodir: str) -> None:
+        self.omerodir = omerodir
+        self._cfg = None  # type: Optional[ConfigXml]
+
+    def _config(self) -> "ConfigXml":
+        if self._cfg is None:
+            self._cfg = _get_config_xml(self.omerodir)
+        return self._cfg
+
+    def close(self) -> None:
+        if self._cfg is not None:
+            cfg = self._cfg
+            self._cfg = None
+            cfg.close()
+
+    def reset_configuration(self) -> None:
+        cfg = self._config()
+        # After a reset the profile doesn't exist until a property is set or
+        # config.xml is saved, and removing it again would fail
+        if cfg.properties(cfg.default()) is not None:
+            cfg.remove()
+
+    def update_from_environment(self) -> None:
+        prefix = _ENV_PREFIX
+        prefix_len = _ENV_PREFIX_LEN
+        environ = os.environ
+        # Iterating over the keys only decodes the values that are used
+        keys = [k for k in environ if k.startswith(prefix)]
+        # Only open config.xml if there's something to set
+        if not keys:
+            return
+        decode = _decode_env_key
+        info = log.info
+        info_enabled = log.isEnabledFor(logging.INFO)
+        cfg = self._config()
+        for k in keys:
+            prop = decode(k[prefix_len:])
+            v = environ[k]
+            if info_enabled:
+                info("Setting: %s=%s", prop, v)
+            cfg[prop] = v
+
+    def update_from_dict(self, dj: Dict[str, Any]) -> None:
+        if dj:
+            _update_from_dict_with_cfg(self._config(), dj)
+
+    def add_from_dict(self, dj: Dict[str, DictOrList]) -> None:
+        if dj:
+            _apply_merges(self._config(), dj)
+
+    def update_from_multilevel_dictfile(self, dictfile: str) -> None:
+        d = _load_multilevel_dictfile(dictfile)
+        _update_from_multilevel_dict_with_cfg(self._config(), d)
+
+    def update_from_multilevel_dictfiles(self, dictfiles: Sequence[str]) -> None:
+        # Parse everything before changing anything
+        self._update_from_multilevel_dicts(_load_multilevel_dictfiles(dictfiles))
+
+    def _update_from_multilevel_dicts(self, ds: Sequence[Any]) -> None:
+        """
+        Apply dictfiles already parsed by _load_multilevel_dictfiles
+        """
+        if not ds:
+            return
+        cfg = self._config()
+        for d in ds:
+            _update_from_multilevel_dict_with_cfg(cfg, d)
+
+
+def clear_cache() -> None:
+    """
+    Discard all cached dictfile contents and OMERO.web defaults, and the
+    Jinja2 environment so OMERO_EXTERNALCONFIG_J2_CACHE is read again.
+    """
+    global _J2_ENV
+    _J2_ENV = None
+    _DICTFILE_CACHE.clear()
+    _load_omeroweb_default.cache_clear()
+
+
+@contextmanager
+def batch(omerodir: str) -> Iterator[_Batch]:
+    """
+    Combine multiple updates to OMERO config.xml so that it's read and
+    written once, for example:
+
+        with batch(omerodir) as b:
+            b.update_from_multilevel_dictfiles(files)
+            b.update_from_environment()
+
+    The returned object has methods reset_configuration,
+    update_from_environment, update_from_dict, add_from_dict,
+    update_from_multilevel_dictfile and update_from_multilevel_dictfiles
+    which take the same arguments as the functions of the same name, without
+    omerodir.
+    config.xml is not opened if nothing is changed.
 
     :param omerodir str: OMERODIR
     """
-    cfg = _get_config_xml(omerodir)
+    b = _Batch(omerodir)
     try:
-        cfg.remove()
+        yield b
     finally:
-        cfg.close()
+        b.close()
+
+
+def reset_configuration(omerodir: str) -> None:
+    """
+    Delete current OMERO config.xml properties.
+
+    :param omerodir str: OMERODIR
+    """
+    with batch(omerodir) as b:
+        b.reset_configuration()
 
 
 def update_from_environment(omerodir: str) -> None:
@@ -149,14 +602,8 @@ def update_from_environment(omerodir: str) -> None:
 
     :param omerodir str: OMERODIR
     """
-    cfg = {}
-    for (k, v) in os.environ.items():
-        if k.startswith("CONFIG_"):
-            prop = k[7:]
-            prop = sub("([^_])_([^_])", r"\1.\2", prop)
-            prop = sub("__", "_", prop)
-            cfg[prop] = v
-    update_from_dict(omerodir, cfg)
+    with batch(omerodir) as b:
+        b.update_from_environment()
 
 
 def update_from_dict(omerodir: str, dj: Dict[str, Any]) -> None:
@@ -169,15 +616,8 @@ def update_from_dict(omerodir: str, dj: Dict[str, Any]) -> None:
            If dictionary values are strings they will be used directly.
            All other types will be converted to a JSON string.
     """
-    cfg = _get_config_xml(omerodir)
-    try:
-        for (k, v) in dj.items():
-            if not isinstance(v, str):
-                v = json.dumps(v, sort_keys=True, ensure_ascii=False)
-            log.info("Setting: %s=%s", k, v)
-            cfg[k] = v
-    finally:
-        cfg.close()
+    with batch(omerodir) as b:
+        b.update_from_dict(dj)
 
 
 def add_from_dict(omerodir: str, dj: Dict[str, DictOrList]) -> None:
@@ -191,19 +631,8 @@ def add_from_dict(omerodir: str, dj: Dict[str, DictOrList]) -> None:
            Dictionary values must be lists or dicts.
            Each item in the list/dict will be added to the property.
     """
-    cfg = _get_config_xml(omerodir)
-    try:
-        jv = []  # type: DictOrList
-        for (k, vs) in dj.items():
-            if isinstance(vs, list):
-                jv = _append_to_list(cfg, k, vs)
-                log.info("Appending: %s=%s", k, jv)
-            elif isinstance(vs, dict):
-                jv = _add_to_dict(cfg, k, vs)
-                log.info("Adding: %s=%s", k, jv)
-            cfg[k] = json.dumps(jv, sort_keys=True, ensure_ascii=False)
-    finally:
-        cfg.close()
+    with batch(omerodir) as b:
+        b.add_from_dict(dj)
 
 
 def update_from_multilevel_dictfile(omerodir: str, dictfile: str) -> None:
@@ -227,26 +656,30 @@ def update_from_multilevel_dictfile(omerodir: str, dictfile: str) -> None:
     have their values appended to.
     All other keys are currently ignored, though this may change in future.
 
+    Parsed files are cached in memory and only re-read if their modification
+    time or size changes.
+    If OMERO_EXTERNALCONFIG_CACHE is set parsed files are also cached as JSON
+    in that directory.
+
     :param omerodir str: OMERODIR
     :param dictfile str: Path to a file that can be parsed as a multi-level
            dictionary, or a Jinaj2 file that will be rendered to the
            aforementioned.
     """
-    try:
-        if dictfile.endswith(".j2"):
-            with TemporaryDirectory() as tmpdir:
-                tmpdictfile = _parse_jinja2(dictfile, tmpdir)
-                d = pydict_text_io.load(tmpdictfile)
-        else:
-            d = pydict_text_io.load(dictfile)
-    except Exception as e:
-        raise ExternalConfigException(
-            "Failed to parse {}: {}".format(dictfile, e)
-        ) from e
-    for topk, topv in sorted(d.items()):
-        if topk.endswith("_append"):
-            add_from_dict(omerodir, topv)
-        elif topk.endswith("_set"):
-            update_from_dict(omerodir, topv)
-        else:
-            log.warning("Ignoring top-level key {}".format(topk))
+    with batch(omerodir) as b:
+        b.update_from_multilevel_dictfile(dictfile)
+
+
+def update_from_multilevel_dictfiles(omerodir: str, dictfiles: Sequence[str]) -> None:
+    """
+    Updates OMERO config.xml from multiple files, see
+    update_from_multilevel_dictfile.
+
+    Files are read and parsed in parallel, then applied in the order given.
+    Nothing is applied if any file fails to parse.
+
+    :param omerodir str: OMERODIR
+    :param dictfiles list: Paths to multi-level dictionary or Jinja2 files
+    """
+    with batch(omerodir) as b:
+        b.update_from_multilevel_dictfiles(dictfiles)
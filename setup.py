@@ -18,9 +18,10 @@ setuptools.setup(
     url="https://github.com/ome/omero-cli-externalconfig",
     packages=["omero_externalconfig", "omero.plugins"],
     setup_requires=["setuptools_scm"],
-    install_requires=["omero-py>=5.6.0"],
+    install_requires=["omero-py>=5.6.0", "PyYAML"],
     extras_require={
         "jinja": ["jinja2"],
+        "orjson": ["orjson"],
     },
     use_scm_version={"write_to": "omero_externalconfig/_version.py"},
     classifiers=[
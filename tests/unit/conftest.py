@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from omero_externalconfig import externalconfig
+from omero_externalconfig.externalconfig import _get_config_xml
+
+
+class _MemConfigXml(dict):
+    """
+    In-memory replacement for the parts of ConfigXml used by
+    omero_externalconfig, so most tests don't need to read, lock and write
+    config.xml
+    """
+
+    VERSION = {"omero.config.version": "5.1.0"}
+
+    def __init__(self):
+        super().__init__(self.VERSION)
+
+    def __setitem__(self, key, value):
+        # Like ConfigXml setting a property recreates a removed profile
+        if not self:
+            self.update(self.VERSION)
+        super().__setitem__(key, value)
+
+    def default(self):
+        return "default"
+
+    def properties(self, id):
+        # An empty dict means the profile has been removed
+        return self if self else None
+
+    def as_map(self):
+        return dict(self)
+
+    def remove(self):
+        self.clear()
+
+    def close(self):
+        if not self:
+            self.update(self.VERSION)
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "configxml: use the real ConfigXml instead of an in-memory double"
+    )
+
+
+@pytest.fixture(autouse=True)
+def mem_config_xml(request, monkeypatch):
+    """
+    Replace ConfigXml with an in-memory double for each OMERODIR, unless the
+    test is marked with configxml
+    """
+    if request.node.get_closest_marker("configxml"):
+        return
+    configs = {}
+    monkeypatch.setattr(
+        externalconfig,
+        "_get_config_xml",
+        lambda omerodir: configs.setdefault(omerodir, _MemConfigXml()),
+    )
+
+
+@pytest.fixture(scope="session")
+def omerodir_template(tmp_path_factory):
+    """
+    An OMERODIR containing an empty etc/grid/config.xml, created once per
+    session and copied for each test
+    """
+    template = tmp_path_factory.mktemp("template")
+    (template / "etc" / "grid").mkdir(parents=True)
+    _get_config_xml(os.fspath(template)).close()
+    return template
+
+
+def _tmpfs_dir():
+    """
+    A writeable memory backed directory for the config.xml files written by
+    ConfigXml, or None to use the default temporary directory
+    """
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return shm
+    return None
+
+
+@pytest.fixture
+def omerodir(monkeypatch, omerodir_template):
+    """
+    An OMERODIR containing an empty config.xml, OMERODIR is also set in the
+    environment
+    """
+    with tempfile.TemporaryDirectory(prefix="omerodir-", dir=_tmpfs_dir()) as d:
+        # copytree requires the destination to not exist on Python < 3.8
+        omerodir = os.path.join(d, "OMERODIR")
+        shutil.copytree(omerodir_template, omerodir)
+        monkeypatch.setenv("OMERODIR", omerodir)
+        yield omerodir
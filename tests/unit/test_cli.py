@@ -0,0 +1,59 @@
+from glob import glob
+import os
+
+from omero.cli import CLI
+import pytest
+
+from omero_externalconfig import update_from_dict
+from omero_externalconfig.cli import ExternalConfigControl, _expand_glob
+from omero_externalconfig.externalconfig import (
+    ExternalConfigException,
+    _get_config_xml,
+)
+
+
+class TestExternalConfigControl(object):
+    def test_expand_glob(self, monkeypatch, tmp_path):
+        (tmp_path / "conf.d" / "sub").mkdir(parents=True)
+        for f in ("a.yml", "b.yml", "c.json", ".hidden.yml", "sub/d.yml"):
+            (tmp_path / "conf.d" / f).touch()
+        monkeypatch.chdir(tmp_path)
+
+        for pattern in (
+            "conf.d/*.yml",
+            "conf.d/*",
+            "conf.d/.*",
+            "conf.d/a.yml",
+            "conf.d/.hidden.yml",
+            "conf.d/missing.yml",
+            "missing/*.yml",
+            "conf.d/[ab].yml",
+            "*/*.yml",
+            "conf.d/**/*.yml",
+            os.fspath(tmp_path / "conf.d" / "*.yml"),
+        ):
+            assert _expand_glob(pattern) == sorted(glob(pattern)), pattern
+
+    @pytest.mark.configxml
+    def test_reset_invalid_file(self, omerodir, tmp_path):
+        update_from_dict(omerodir, {"test.key": "abc"})
+        good = tmp_path / "good.yml"
+        good.write_text("config_set:\n  omero.db.poolsize: 25\n")
+        bad = tmp_path / "bad.yml"
+        bad.write_text("config_set: [\n")
+
+        cli = CLI()
+        cli.register("externalconfig", ExternalConfigControl, "")
+        with pytest.raises(ExternalConfigException):
+            cli.invoke(
+                ["externalconfig", "--reset", os.fspath(good), os.fspath(bad)],
+                strict=True,
+            )
+
+        # Nothing, including the reset, is applied if any file is invalid
+        configxml = _get_config_xml(omerodir)
+        try:
+            cfg = configxml.as_map()
+        finally:
+            configxml.close()
+        assert cfg == {"omero.config.version": "5.1.0", "test.key": "abc"}
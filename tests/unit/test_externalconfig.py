@@ -1,111 +1,42 @@
+import json
+import os
+import sys
+
+import pytest
+
 from omero_externalconfig import (
     add_from_dict,
+    batch,
+    clear_cache,
     reset_configuration,
     update_from_environment,
     update_from_dict,
     update_from_multilevel_dictfile,
+    update_from_multilevel_dictfiles,
+)
+from omero_externalconfig import externalconfig
+from omero_externalconfig.externalconfig import (
+    ExternalConfigException,
+    _decode_env_key,
+    _get_config_xml,
 )
-from omero_externalconfig.externalconfig import _get_config_xml
+
+
+def _as_map(configxml):
+    return {
+        k: v for (k, v) in configxml.as_map().items() if k != "omero.config.version"
+    }
 
 
 def _get_config(omerodir):
-    configxml = _get_config_xml(omerodir)
+    configxml = externalconfig._get_config_xml(omerodir)
     try:
-        cfg = configxml.as_map()
-        cfg.pop("omero.config.version")
-        return cfg
+        return _as_map(configxml)
     finally:
         configxml.close()
 
 
-class TestExternalConfig(object):
-    def test_reset_configuration(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
-
-        configxml = _get_config_xml(omerodir)
-        configxml["test.key"] = "abc"
-        configxml.close()
-        assert _get_config(omerodir) == {"test.key": "abc"}
-
-        reset_configuration(omerodir)
-        assert _get_config(omerodir) == {}
-
-    def test_update_from_environment(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
-
-        monkeypatch.setenv("CONFIG_omero_data_dir", "/external/data")
-        monkeypatch.setenv("CONFIG_omero_web_public_url__filter", "/public")
-        update_from_environment(omerodir)
-
-        cfg = _get_config(omerodir)
-        assert cfg == {
-            "omero.data.dir": "/external/data",
-            "omero.web.public.url_filter": "/public",
-        }
-
-    def test_update_from_dict(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
-
-        d = {"a": 123, "b": "c d e", "c": [{"k": "v", "b": True}]}
-        update_from_dict(omerodir, d)
-
-        cfg = _get_config(omerodir)
-        assert cfg == {
-            "a": "123",
-            "b": "c d e",
-            "c": '[{"b": true, "k": "v"}]',
-        }
-
-    def test_add_from_dict_extend(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
-
-        update_from_dict(omerodir, {"initial.key": ["value1"]})
-
-        d = {"initial.key": ["value2", "value3"], "other.key": [{"a": 1}]}
-        add_from_dict(omerodir, d)
-
-        cfg = _get_config(omerodir)
-        assert cfg == {
-            "initial.key": '["value1", "value2", "value3"]',
-            "other.key": '[{"a": 1}]',
-        }
-
-    def test_add_from_dict_update(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
-
-        update_from_dict(
-            omerodir,
-            {
-                "initial.key": {"key1": "value1", "key2": "value2"},
-                "other.key": {"b": 2},
-            },
-        )
-
-        d = {"initial.key": {"key2": 123, "key3": {"a": 1}}}
-        add_from_dict(omerodir, d)
-
-        cfg = _get_config(omerodir)
-        assert cfg == {
-            "initial.key": ('{"key1": "value1", "key2": 123, "key3": {"a": 1}}'),
-            "other.key": '{"b": 2}',
-        }
-
-    def test_update_from_multilevel_dictfile(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
-
-        content = """
+_MULTILEVEL_YAML = b"""
 omero_server_config_set:
   omero.db.poolsize: 25
   # Websockets (no wss for now to avoid dealing with certificates)
@@ -163,55 +94,211 @@ omero_web_apps_config_set:
 ignored_key:
   omero.data.dir: /ignored
 """
-        (tmpdir / "input.yml").write(content)
 
-        update_from_multilevel_dictfile(omerodir, str(tmpdir / "input.yml"))
+_MULTILEVEL_EXPECTED = {
+    "omero.client.icetransports": "ssl,tcp,ws",
+    "omero.db.poolsize": "25",
+    "omero.web.mapr.config": (
+        '[{"config": {"all": ["Gene Symbol", "Gene Identifier"], '
+        '"case_sensitive": true, "default": ["Gene Symbol"], '
+        '"label": "Gene", "ns": ["openmicroscopy.org/mapr/gene"]}, '
+        '"menu": "gene"}, {"config": {"all": [], "default": [], '
+        '"label": "Gene supplementary", "ns": '
+        '["openmicroscopy.org/mapr/gene/supplementary"]}, '
+        '"menu": "genesupplementary"}]'
+    ),
+    "omero.web.open_with": (
+        '[["Image viewer", "webgateway", {"script_url": '
+        '"webclient/javascript/ome.openwith_viewer.js", '
+        '"supported_objects": ["image"]}], ["omero_iviewer", '
+        '"omero_iviewer_index", {"label": "OMERO.iviewer", '
+        '"script_url": "omero_iviewer/openwith.js", '
+        '"supported_objects": ["image", "dataset", "well"]}], '
+        '["omero_figure", "new_figure", {"label": "OMERO.figure", '
+        '"supported_objects": ["images"], "target": "_blank"}]]'
+    ),
+    "omero.web.server_list": (
+        '[["localhost", 4064, "omero"], ["idr.openmicroscopy.org", 4064, "idr"]]'
+    ),
+    "omero.web.this.key.doesnt.exist.list": '["abc", "def"]',
+    "omero.web.this.key.doesnt.exist.dict": '{"abc": 1, "def": 2}',
+}
+
+
+class TestExternalConfig(object):
+    @pytest.mark.configxml
+    def test_reset_configuration(self, omerodir):
+        configxml = _get_config_xml(omerodir)
+        configxml["test.key"] = "abc"
+        configxml.close()
+        assert _get_config(omerodir) == {"test.key": "abc"}
+
+        reset_configuration(omerodir)
+        assert _get_config(omerodir) == {}
+
+    @pytest.mark.configxml
+    def test_batch_reset_configuration(self, omerodir):
+        update_from_dict(omerodir, {"test.key": "abc"})
+        with batch(omerodir) as b:
+            b.reset_configuration()
+            b.reset_configuration()
+        assert _get_config(omerodir) == {}
+
+        with batch(omerodir) as b:
+            b.reset_configuration()
+            b.update_from_dict({"test.key": "def"})
+            b.reset_configuration()
+            b.update_from_dict({"other.key": "ghi"})
+        assert _get_config(omerodir) == {"other.key": "ghi"}
+
+    def test_update_from_environment(self, omerodir, monkeypatch):
+        env = {
+            "CONFIG_omero_data_dir": "/external/data",
+            "CONFIG_omero_web_public_url__filter": "/public",
+        }
+        # A plain dict avoids a putenv call for every variable
+        monkeypatch.setattr(os, "environ", {**os.environ, **env})
+        update_from_environment(omerodir)
+
+        cfg = _get_config(omerodir)
+        assert cfg == {
+            "omero.data.dir": "/external/data",
+            "omero.web.public.url_filter": "/public",
+        }
+
+    def test_decode_env_key(self):
+        assert _decode_env_key("omero_data_dir") == "omero.data.dir"
+        assert _decode_env_key("omero_web_public_url__filter") == (
+            "omero.web.public.url_filter"
+        )
+        # Single character components
+        assert _decode_env_key("a_b_c") == "a.b.c"
+        # An odd number of underscores is an escaped underscore and a "."
+        assert _decode_env_key("a___b") == "a_.b"
+
+    @pytest.mark.configxml
+    def test_empty_updates(self, monkeypatch, tmp_path):
+        # There's no etc/grid so config.xml can't be opened
+        omerodir = os.fspath(tmp_path)
+        for k in list(os.environ):
+            if k.startswith("CONFIG_"):
+                monkeypatch.delenv(k)
+
+        update_from_environment(omerodir)
+        update_from_dict(omerodir, {})
+        add_from_dict(omerodir, {})
+        with batch(omerodir) as b:
+            b.update_from_environment()
+            b.update_from_dict({})
+            b.add_from_dict({})
+        assert list(tmp_path.iterdir()) == []
+
+    def test_update_from_dict(self, omerodir):
+        d = {"a": 123, "b": "c d e", "c": [{"k": "v", "b": True}]}
+        update_from_dict(omerodir, d)
+
+        cfg = _get_config(omerodir)
+        assert cfg == {
+            "a": "123",
+            "b": "c d e",
+            "c": '[{"b": true, "k": "v"}]',
+        }
+
+    def test_add_from_dict_extend(self, omerodir):
+        update_from_dict(omerodir, {"initial.key": ["value1"]})
+
+        d = {"initial.key": ["value2", "value3"], "other.key": [{"a": 1}]}
+        add_from_dict(omerodir, d)
 
         cfg = _get_config(omerodir)
         assert cfg == {
-            "omero.client.icetransports": "ssl,tcp,ws",
-            "omero.db.poolsize": "25",
-            "omero.web.mapr.config": (
-                '[{"config": {"all": ["Gene Symbol", "Gene Identifier"], '
-                '"case_sensitive": true, "default": ["Gene Symbol"], '
-                '"label": "Gene", "ns": ["openmicroscopy.org/mapr/gene"]}, '
-                '"menu": "gene"}, {"config": {"all": [], "default": [], '
-                '"label": "Gene supplementary", "ns": '
-                '["openmicroscopy.org/mapr/gene/supplementary"]}, '
-                '"menu": "genesupplementary"}]'
-            ),
-            "omero.web.open_with": (
-                '[["Image viewer", "webgateway", {"script_url": '
-                '"webclient/javascript/ome.openwith_viewer.js", '
-                '"supported_objects": ["image"]}], ["omero_iviewer", '
-                '"omero_iviewer_index", {"label": "OMERO.iviewer", '
-                '"script_url": "omero_iviewer/openwith.js", '
-                '"supported_objects": ["image", "dataset", "well"]}], '
-                '["omero_figure", "new_figure", {"label": "OMERO.figure", '
-                '"supported_objects": ["images"], "target": "_blank"}]]'
-            ),
-            "omero.web.server_list": (
-                '[["localhost", 4064, "omero"], '
-                '["idr.openmicroscopy.org", 4064, "idr"]]'
-            ),
-            "omero.web.this.key.doesnt.exist.list": '["abc", "def"]',
-            "omero.web.this.key.doesnt.exist.dict": '{"abc": 1, "def": 2}',
+            "initial.key": '["value1", "value2", "value3"]',
+            "other.key": '[{"a": 1}]',
+        }
+
+    def test_add_from_dict_update(self, omerodir):
+        # Check updates in a single batch see earlier changes
+        with batch(omerodir) as b:
+            b.update_from_dict(
+                {
+                    "initial.key": {"key1": "value1", "key2": "value2"},
+                    "other.key": {"b": 2},
+                }
+            )
+            b.add_from_dict({"initial.key": {"key2": 123, "key3": {"a": 1}}})
+
+        cfg = _get_config(omerodir)
+        assert cfg == {
+            "initial.key": ('{"key1": "value1", "key2": 123, "key3": {"a": 1}}'),
+            "other.key": '{"b": 2}',
+        }
+
+    def test_add_from_dict_default_unchanged(self, omerodir, tmp_path):
+        # The cached OMERO.web default must not be modified by an update
+        other = os.fspath(tmp_path)
+        add_from_dict(omerodir, {"omero.web.server_list": [["a", 4064, "a"]]})
+        add_from_dict(other, {"omero.web.server_list": [["b", 4064, "b"]]})
+
+        assert _get_config(omerodir) == {
+            "omero.web.server_list": '[["localhost", 4064, "omero"], ["a", 4064, "a"]]'
+        }
+        assert _get_config(other) == {
+            "omero.web.server_list": '[["localhost", 4064, "omero"], ["b", 4064, "b"]]'
         }
 
-    def test_update_from_multilevel_jinja2file(self, monkeypatch, tmpdir):
-        (tmpdir / "etc" / "grid").ensure(dir=True)
-        omerodir = str(tmpdir)
-        monkeypatch.setenv("OMERODIR", str(omerodir))
+    def test_add_from_dict_json_roundtrip(self, omerodir):
+        # Values that json.dumps writes must be read back unchanged
+        update_from_dict(omerodir, {"test.list": [2 ** 64, float("nan")]})
+        add_from_dict(omerodir, {"test.list": [1]})
 
+        cfg = _get_config(omerodir)
+        assert cfg == {"test.list": "[18446744073709551616, NaN, 1]"}
+
+    @pytest.mark.configxml
+    def test_update_from_multilevel_dictfile(self, omerodir, tmp_path):
+        inputf = tmp_path / "input.yml"
+        inputf.write_bytes(_MULTILEVEL_YAML)
+
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+
+        cfg = _get_config(omerodir)
+        assert cfg == _MULTILEVEL_EXPECTED
+
+    @pytest.mark.parametrize("loads", ["default", "json"])
+    def test_update_from_multilevel_jsonfile(
+        self, omerodir, monkeypatch, tmp_path, loads
+    ):
+        if loads == "json":
+            # Check the fallback if orjson isn't installed
+            monkeypatch.setattr(externalconfig, "_loads", json.loads)
+        inputf = tmp_path / "input.json"
+        inputf.write_text('{"config_set": {"omero.db.poolsize": 25}}')
+
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+
+        cfg = _get_config(omerodir)
+        assert cfg == {"omero.db.poolsize": "25"}
+
+    def test_update_from_multilevel_jsonstring(self, omerodir):
+        # A JSON string instead of a file name is passed to pydict_text_io
+        update_from_multilevel_dictfile(
+            omerodir, '{"config_set": {"omero.db.poolsize": 25}}'
+        )
+
+        cfg = _get_config(omerodir)
+        assert cfg == {"omero.db.poolsize": "25"}
+
+    def test_update_from_multilevel_jinja2file(self, omerodir, tmp_path):
         content = """
 omero_server_config_set:
   omero.db.host: {{ external_database_ip | default('localhost') }}
   omero.db.user: {{ external_database_user | default('dbuser') }}
   omero.db.pass: {{ external_database_pass | default('dbpassword') }}
 """
-        (tmpdir / "input.yml.j2").write(content)
+        inputf = tmp_path / "input.yml.j2"
+        inputf.write_text(content)
 
-        update_from_multilevel_dictfile(omerodir, str(tmpdir / "input.yml.j2"))
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
 
         cfg = _get_config(omerodir)
         assert cfg == {
@@ -219,3 +306,156 @@ omero_server_config_set:
             "omero.db.user": "dbuser",
             "omero.db.pass": "dbpassword",
         }
+
+    @pytest.mark.parametrize(
+        "tag", ['include "{}"', 'import "{}" as m', 'extends "{}"']
+    )
+    def test_update_from_multilevel_jinja2file_include(self, omerodir, tmp_path, tag):
+        # Included files aren't tracked by the caches so they aren't allowed
+        other = tmp_path / "other.yml"
+        other.write_text("config_set:\n  omero.db.host: other\n")
+        inputf = tmp_path / "input.yml.j2"
+        inputf.write_text("{% " + tag.format(other) + " %}\n")
+
+        with pytest.raises(ExternalConfigException, match="other.yml"):
+            update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+
+    def test_update_from_multilevel_jinja2file_cached(
+        self, omerodir, monkeypatch, tmp_path
+    ):
+        cachedir = tmp_path / "j2cache"
+        monkeypatch.setenv("OMERO_EXTERNALCONFIG_J2_CACHE", os.fspath(cachedir))
+        clear_cache()
+        try:
+            inputf = tmp_path / "input.yml.j2"
+            inputf.write_text(
+                "config_set:\n  omero.db.host: {{ host | default('localhost') }}\n"
+            )
+            update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        finally:
+            # Don't use the bytecode cache in other tests
+            clear_cache()
+
+        assert _get_config(omerodir) == {"omero.db.host": "localhost"}
+        assert len(list(cachedir.iterdir())) == 1
+
+    def test_update_from_multilevel_dictfile_cached(
+        self, omerodir, monkeypatch, tmp_path
+    ):
+        clear_cache()
+
+        inputf = tmp_path / "input.yml"
+        inputf.write_text("config_set:\n  omero.db.poolsize: 25\n")
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert _get_config(omerodir) == {"omero.db.poolsize": "25"}
+
+        # The unchanged file must be read from the in-memory cache
+        update_from_dict(omerodir, {"omero.db.poolsize": "1"})
+        with monkeypatch.context() as m:
+            m.setattr(externalconfig, "_load_with_sidecar", pytest.fail)
+            update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert _get_config(omerodir) == {"omero.db.poolsize": "25"}
+
+        # Changing the file must invalidate the cached content
+        inputf.write_text("config_set:\n  omero.db.poolsize: 100\n")
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert _get_config(omerodir) == {"omero.db.poolsize": "100"}
+
+    def test_update_from_multilevel_dictfile_jsoncache(
+        self, omerodir, monkeypatch, tmp_path
+    ):
+        monkeypatch.setenv("OMERO_EXTERNALCONFIG_CACHE", os.fspath(tmp_path / "cache"))
+        clear_cache()
+
+        inputf = tmp_path / "input.yml"
+        inputf.write_text("config_set:\n  omero.db.poolsize: 25\n")
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert len(list((tmp_path / "cache").iterdir())) == 1
+
+        # The in-memory cache is empty so this must be read from the JSON cache
+        clear_cache()
+        update_from_dict(omerodir, {"omero.db.poolsize": "1"})
+        with monkeypatch.context() as m:
+            m.setattr(externalconfig, "_load_dictfile", pytest.fail)
+            update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert _get_config(omerodir) == {"omero.db.poolsize": "25"}
+
+    @pytest.mark.skipif(
+        sys.platform == "win32" or sys.getfilesystemencoding() != "utf-8",
+        reason="Requires POSIX file names that aren't valid UTF-8",
+    )
+    def test_update_from_multilevel_dictfile_jsoncache_undecodable(
+        self, omerodir, monkeypatch, tmp_path
+    ):
+        monkeypatch.setenv("OMERO_EXTERNALCONFIG_CACHE", os.fspath(tmp_path / "cache"))
+        clear_cache()
+
+        inputf = os.path.join(os.fspath(tmp_path), os.fsdecode(b"\xff.yml"))
+        with open(inputf, "w") as f:
+            f.write("config_set:\n  omero.db.poolsize: 25\n")
+        update_from_multilevel_dictfile(omerodir, inputf)
+        assert _get_config(omerodir) == {"omero.db.poolsize": "25"}
+        assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    def test_update_from_multilevel_dictfile_jsoncache_untrusted(
+        self, omerodir, monkeypatch, tmp_path
+    ):
+        cachedir = tmp_path / "cache"
+        monkeypatch.setenv("OMERO_EXTERNALCONFIG_CACHE", os.fspath(cachedir))
+        clear_cache()
+
+        inputf = tmp_path / "input.yml"
+        inputf.write_text("config_set:\n  omero.db.poolsize: 25\n")
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        (sidecar,) = cachedir.iterdir()
+
+        # A cache file that others can write must be ignored
+        cached = json.loads(sidecar.read_text())
+        cached["content"]["config_set"]["omero.db.poolsize"] = 99
+        sidecar.write_text(json.dumps(cached))
+        sidecar.chmod(0o666)
+        clear_cache()
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert _get_config(omerodir) == {"omero.db.poolsize": "25"}
+
+        # As must a cache directory that others can write
+        sidecar.unlink()
+        cachedir.chmod(0o777)
+        clear_cache()
+        update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        assert list(cachedir.iterdir()) == []
+
+    def test_update_from_multilevel_dictfile_jsoncache_failed(
+        self, omerodir, monkeypatch, tmp_path
+    ):
+        def fail(*args):
+            raise OSError("replace failed")
+
+        cachedir = tmp_path / "cache"
+        monkeypatch.setenv("OMERO_EXTERNALCONFIG_CACHE", os.fspath(cachedir))
+        clear_cache()
+
+        inputf = tmp_path / "input.yml"
+        inputf.write_text("config_set:\n  omero.db.poolsize: 25\n")
+        with monkeypatch.context() as m:
+            m.setattr(os, "replace", fail)
+            update_from_multilevel_dictfile(omerodir, os.fspath(inputf))
+        # The temporary file must be removed
+        assert list(cachedir.iterdir()) == []
+        assert _get_config(omerodir) == {"omero.db.poolsize": "25"}
+
+    def test_update_from_multilevel_dictfiles(self, omerodir, tmp_path):
+        inputfs = []
+        for n in range(4):
+            inputf = tmp_path / "input{}.yml".format(n)
+            inputf.write_text(
+                "a_set:\n  omero.db.poolsize: {}\n"
+                "b_append:\n  test.list: [{}]\n".format(n, n)
+            )
+            inputfs.append(os.fspath(inputf))
+
+        # Files must be applied in the order given
+        update_from_multilevel_dictfiles(omerodir, inputfs[::-1])
+
+        cfg = _get_config(omerodir)
+        assert cfg == {"omero.db.poolsize": "0", "test.list": "[3, 2, 1, 0]"}